@@ -1,74 +1,272 @@
+import atexit
 import concurrent.futures
+import functools
 import hashlib
 import os
 import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
 from datetime import datetime
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+
+MAX_DOWNLOADS = min(32, (os.cpu_count() or 4) * 4)
+
+_SANITIZE = re.compile(r'[<>:"/\\|?*]')
+
+# One client shared by every download thread. HTTP/2 lets downloads from the
+# same CDN host share a single connection instead of one handshake each.
+SESSION = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    headers={'User-Agent': 'Mozilla/5.0'},
+    follow_redirects=True,
+)
+atexit.register(SESSION.close)
+
+# Long-lived pool shared by every download, sized for I/O-bound work.
+# Registered after SESSION so it is shut down before the client is closed.
+_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DOWNLOADS, thread_name_prefix='dl')
+atexit.register(_POOL.shutdown, wait=True)
+
+
+def iter_podcast_titles(opml_path: str):
+    """Yield the title of each podcast feed in the OPML export."""
+    for _, elem in ET.iterparse(opml_path):
+        if elem.tag == 'outline' and elem.get('type') == 'rss':
+            yield elem.get('title', '')
+            elem.clear()
+
+
+def iter_played_episodes(opml_path: str, selected):
+    """Yield (podcast number, attributes) for each played episode of the selected podcasts.
+
+    Podcasts are numbered from 1 in document order, matching iter_podcast_titles.
+    Only episodes nested inside a feed are considered. Elements are cleared
+    as soon as they are consumed so the tree never builds up in memory.
+    """
+    number = 0
+    current = 0  # Number of the enclosing feed, or 0 outside any feed.
+    for event, elem in ET.iterparse(opml_path, events=('start', 'end')):
+        if elem.tag != 'outline':
+            continue
+        kind = elem.get('type')
+        if event == 'start':
+            if kind == 'rss':
+                number += 1
+                current = number
+        elif kind == 'podcast-episode':
+            if current in selected and elem.get('played') == '1':
+                yield current, dict(elem.attrib)
+            elem.clear()
+        elif kind == 'rss':
+            current = 0
+            elem.clear()
 
 
 class PodcastDownloader:
     def __init__(self, source_file: str):
         """Initialize the PodcastDownloader object with the source_file path."""
         self.source_file = source_file
-        self.downloaded_file = 'downloaded_episodes.txt'
+        self.downloaded_file = 'downloaded_episodes.db'
+        self.legacy_downloaded_file = 'downloaded_episodes.txt'
+        self.db = sqlite3.connect(self.downloaded_file, isolation_level=None, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode NORMAL only syncs at checkpoints, so each recorded
+        # download no longer waits on an fsync.
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS downloaded (hash TEXT PRIMARY KEY)')
+        self.import_legacy_episodes()
         self.downloaded_episodes = self.load_downloaded_episodes()
+        # Keys written before hash_url switched to BLAKE2b; they are re-keyed
+        # the first time their episode is seen again.
+        self.legacy_episodes = {h for h in self.downloaded_episodes if len(h) == 64}
+        self.downloaded_episodes -= self.legacy_episodes
+        # Filenames saved in each podcast directory, filled in by download_podcasts.
+        self.podcast_indexes = {}
+        # Full paths of episodes currently being downloaded.
+        self.claimed_paths = set()
+        self.index_lock = threading.Lock()
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def sanitize_filename(filename: str) -> str:
         """Sanitize filenames by replacing invalid characters."""
-        return re.sub(r'[<>:"/\\|?*]', ' ', filename)
+        return _SANITIZE.sub(' ', filename)
 
     @staticmethod
     def hash_url(url: str) -> str:
+        return hashlib.blake2b(url.encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def legacy_hash_url(url: str) -> str:
         return hashlib.sha256(url.encode('utf-8')).hexdigest()
 
-    def load_downloaded_episodes(self) -> set:
-        """Load downloaded episodes from the file."""
+    def import_legacy_episodes(self):
+        """Move hashes from the old text file into the database, once."""
         try:
-            with open(self.downloaded_file, 'r') as file:
-                return set(line.strip() for line in file)
+            with open(self.legacy_downloaded_file, 'r') as file:
+                hashes = [(line.strip(),) for line in file if line.strip()]
         except FileNotFoundError:
-            return set()
+            return
+
+        with self.db_lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR IGNORE INTO downloaded VALUES (?)', hashes)
+            self.db.execute('COMMIT')
+        os.replace(self.legacy_downloaded_file, self.legacy_downloaded_file + '.imported')
+
+    def load_downloaded_episodes(self) -> set:
+        """Load downloaded episodes from the database."""
+        with self.db_lock:
+            return {row[0] for row in self.db.execute('SELECT hash FROM downloaded')}
+
+    def mark_downloaded(self, url_hash: str):
+        """Record a finished download in the database."""
+        with self.db_lock:
+            self.db.execute('INSERT OR IGNORE INTO downloaded VALUES (?)', (url_hash,))
+            self.downloaded_episodes.add(url_hash)
+
+    def is_downloaded(self, url: str, url_hash: str) -> bool:
+        """Check whether a URL was downloaded, migrating legacy SHA-256 keys."""
+        if url_hash in self.downloaded_episodes:
+            return True
+        if not self.legacy_episodes:
+            return False
+
+        legacy_hash = self.legacy_hash_url(url)
+        if legacy_hash not in self.legacy_episodes:
+            return False
+        with self.db_lock:
+            self.db.execute('BEGIN')
+            self.db.execute('INSERT OR IGNORE INTO downloaded VALUES (?)', (url_hash,))
+            self.db.execute('DELETE FROM downloaded WHERE hash = ?', (legacy_hash,))
+            self.db.execute('COMMIT')
+        return True
+
+    @staticmethod
+    def load_podcast_index(podcast_dir: str) -> set:
+        """List the episodes already saved in a podcast directory."""
+        return {entry.name for entry in os.scandir(podcast_dir) if not entry.name.endswith('.part')}
+
+    @staticmethod
+    def matches_remote_size(url: str, local_size: int):
+        """Compare a local file size against the Content-Length reported by a HEAD request.
+
+        Returns True or False, or None when the remote size can't be determined.
+        """
+        try:
+            r = SESSION.head(url, headers={'Accept-Encoding': 'identity'})
+            r.raise_for_status()
+            remote_size = int(r.headers['Content-Length'])
+        except (httpx.HTTPError, KeyError, ValueError):
+            return None
+        return remote_size == local_size
+
+    def episode_paths(self, episode, podcast_dir):
+        """Return the filename an episode is saved under and its full path."""
+        title = episode.get('title', '')
+        pub_date = episode.get('pubDate', '')
+        formatted_date = ''
+        try:
+            dt = datetime.strptime(pub_date, "%Y-%m-%dT%H:%M:%S%z")
+            formatted_date = dt.strftime('%Y-%m-%d')
+        except ValueError:
+            print(f"Could not parse date '{pub_date}' for episode '{title}'.")
+
+        filename = f"{formatted_date} {self.sanitize_filename(title)}.mp3"
+        return filename, os.path.join(podcast_dir, filename)
 
     def download_episode(self, episode, podcast_dir):
-        """Download a podcast episode."""
-        if 'played' in episode.attrs and episode['played'] == '1':
-            mp3_url = episode.get('enclosureUrl', None)
-            if mp3_url is None:
-                print(f"No URL found for the episode '{episode.get('title', '')}'. Skipping.")
-                return
+        """Download a played podcast episode unless it is already on disk."""
+        title = episode.get('title', '')
+        mp3_url = episode.get('enclosureUrl', None)
+        if mp3_url is None:
+            print(f"No URL found for the episode '{title}'. Skipping.")
+            return
 
-            url_hash = self.hash_url(mp3_url)
-            if url_hash in self.downloaded_episodes:
-                print(f"Episode '{episode['title']}' already exists. Skipping.")
+        url_hash = self.hash_url(mp3_url)
+        if self.is_downloaded(mp3_url, url_hash):
+            print(f"Episode '{title}' already exists. Skipping.")
+            return
+
+        filename, mp3_file = self.episode_paths(episode, podcast_dir)
+        # Claim the path first so two episodes that map to the same filename
+        # never write to the same .part file at once.
+        with self.index_lock:
+            if mp3_file in self.claimed_paths:
+                print(f"Episode '{title}' has the same filename as one already downloading. Skipping.")
                 return
+            self.claimed_paths.add(mp3_file)
+        try:
+            self.save_episode(title, mp3_url, url_hash, filename, mp3_file,
+                              self.podcast_indexes[podcast_dir])
+        finally:
+            with self.index_lock:
+                self.claimed_paths.discard(mp3_file)
 
-            # Handling date and formatting
-            pub_date = episode.get('pubDate', '')
-            formatted_date = ''
+    def save_episode(self, title, mp3_url, url_hash, filename, mp3_file, podcast_index):
+        """Fetch an episode to mp3_file, which the caller has claimed."""
+        if filename in podcast_index:
+            # A single stat both confirms the file is still there and catches
+            # empty leftovers, before spending a HEAD request on it.
             try:
-                dt = datetime.strptime(pub_date, "%Y-%m-%dT%H:%M:%S%z")
-                formatted_date = dt.strftime('%Y-%m-%d')
-            except ValueError:
-                print(f"Could not parse date '{pub_date}' for episode '{episode.get('title', '')}'.")
-
-            sanitized_title = self.sanitize_filename(episode['title'])
-            mp3_file = os.path.join(podcast_dir, f"{formatted_date} {sanitized_title}.mp3")
+                local_size = os.stat(mp3_file).st_size
+            except FileNotFoundError:
+                local_size = 0
+            if local_size > 0:
+                same_size = self.matches_remote_size(mp3_url, local_size)
+                if same_size is None:
+                    # Keep the local copy for now, but leave it unrecorded so
+                    # the next run checks it again.
+                    print(f"Could not compare '{title}' with the remote file. Skipping for now.")
+                    return
+                if same_size:
+                    self.mark_downloaded(url_hash)
+                    print(f"Episode '{title}' already exists. Skipping.")
+                    return
+            print(f"Local copy of '{title}' is empty or differs from the remote file. Re-downloading.")
 
-            # Downloading the episode
-            print(f"Downloading {episode['title']}...")
-            try:
-                with requests.get(mp3_url, stream=True) as r:
-                    r.raise_for_status()
-                    with open(mp3_file, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                with open(self.downloaded_file, 'a') as f:
-                    f.write(f"{url_hash}\n")
-            except Exception as e:
-                print(f"Failed to download the episode '{episode['title']}'. Error: {e}")
+        # Downloading the episode
+        print(f"Downloading {title}...")
+        tmp_path = None
+        try:
+            # Ask for the body as-is; MP3s gain nothing from gzip and the
+            # stream can then be written straight to disk.
+            with SESSION.stream('GET', mp3_url, headers={'Accept-Encoding': 'identity'}) as r:
+                r.raise_for_status()
+                # Write next to the final path so os.replace is an atomic
+                # same-filesystem rename rather than a copy.
+                tmp_path = mp3_file + '.part'
+                # Write chunks as they arrive rather than re-buffering them;
+                # decode only if the server ignored the identity request.
+                if r.headers.get('Content-Encoding', 'identity') == 'identity':
+                    chunks = r.iter_raw()
+                else:
+                    chunks = r.iter_bytes()
+                with open(tmp_path, 'wb') as tmp:
+                    for chunk in chunks:
+                        tmp.write(chunk)
+            os.replace(tmp_path, mp3_file)
+            tmp_path = None
+            with self.index_lock:
+                podcast_index.add(filename)
+            self.mark_downloaded(url_hash)
+        except Exception as e:
+            print(f"Failed to download the episode '{title}'. Error: {e}")
+        finally:
+            # Don't leave half-written files behind on errors or Ctrl-C.
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
 
     def download_podcasts(self):
         """Download podcasts listed in the source file."""
@@ -76,18 +274,12 @@ class PodcastDownloader:
             print(f"File '{self.source_file}' not found.")
             return
 
-        with open(self.source_file, 'r') as f:
-            data = f.read()
-
         try:
-            bs_data = BeautifulSoup(data, "xml")
-        except AttributeError as e:
+            podcast_names = list(iter_podcast_titles(self.source_file))
+        except ET.ParseError as e:
             print(f"Failed to parse the file '{self.source_file}' as XML. Error: {e}")
             return
 
-        podcasts = bs_data.find_all('outline', {'type': 'rss'})
-        podcast_names = [podcast['title'] for podcast in podcasts]
-
         print("Available podcasts:")
         for i, name in enumerate(podcast_names, start=1):
             print(f"{i}. {name}")
@@ -104,20 +296,37 @@ class PodcastDownloader:
                 return
             
 
+        podcast_dirs = {}
         for i in selected_podcasts:
-            try:
-                podcast = podcasts[i - 1]
-                podcast_name = podcast_names[i - 1]
-            except IndexError:
+            if not 1 <= i <= len(podcast_names):
                 print(f"No podcast found with the number {i}.")
                 continue
 
-            podcast_dir = os.path.join('podcasts', self.sanitize_filename(podcast_name))
+            podcast_dir = os.path.join('podcasts', self.sanitize_filename(podcast_names[i - 1]))
             os.makedirs(podcast_dir, exist_ok=True)
+            # Build the index here, before any worker thread needs it.
+            self.podcast_indexes[podcast_dir] = self.load_podcast_index(podcast_dir)
+            podcast_dirs[i] = podcast_dir
+
+        # Keep exactly MAX_DOWNLOADS episodes in flight: a slot is taken before
+        # each submit and handed back as soon as that download finishes.
+        slots = threading.Semaphore(MAX_DOWNLOADS)
+
+        def on_done(future):
+            slots.release()
+            error = future.exception()
+            if error is not None:
+                print(f"Unexpected error while downloading an episode. Error: {error}")
+
+        # Episodes stream straight from the parser into the pool, so every
+        # selected podcast shares it and only MAX_DOWNLOADS are held at once.
+        for i, episode in iter_played_episodes(self.source_file, podcast_dirs):
+            slots.acquire()
+            _POOL.submit(self.download_episode, episode, podcast_dirs[i]).add_done_callback(on_done)
 
-            episodes = podcast.find_all('outline')
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                executor.map(self.download_episode, episodes, [podcast_dir] * len(episodes))
+        # Every slot is free again once the last download has finished.
+        for _ in range(MAX_DOWNLOADS):
+            slots.acquire()
 
 
 